@@ -1,46 +1,183 @@
+import hashlib
 import json
 import os
-from flask import Flask, request, abort, jsonify
+import threading
+from flask import Flask, request, abort, jsonify, g
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+from sqlalchemy import bindparam, func, tablesample, text
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+from cachetools import TTLCache
+import orjson
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category, Counter
 
 QUESTIONS_PER_PAGE = 10
 
+# Postgres takes OFFSET as a bigint, so larger offsets can't be sent to it
+MAX_PAGE_OFFSET = 2 ** 63 - 1
+
+# Categories almost never change, so keep the {id: type} dict around for a while
+# TTLCache isn't thread-safe and the server is threaded, so fills go through a lock
+_categories_cache = TTLCache(maxsize=1, ttl=300)
+_categories_lock = threading.Lock()
+
+# Columns selected for question listings; querying these returns plain rows
+# instead of mapped Question objects
+QUESTION_COLUMNS = (
+    Question.id,
+    Question.question,
+    Question.answer,
+    Question.category,
+    Question.difficulty,
+)
+
+
+# One page of questions together with the total count, in a single round trip.
+# json_agg turns each row into an object keyed by column name, so the rows must
+# keep exactly the shape format_questions builds; both come from QUESTION_COLUMNS
+QUESTIONS_PAGE_SQL = text("""
+    WITH page AS (
+        SELECT {columns}
+        FROM questions
+        ORDER BY id
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT
+        (SELECT json_agg(page ORDER BY page.id) FROM page) AS questions,
+        (SELECT n FROM counters WHERE name = 'questions') AS total_questions
+""".format(columns=", ".join(column.key for column in QUESTION_COLUMNS)))
+
+
+# Below this many questions a 1% page sample is almost always empty, so the
+# quiz goes straight to sorting the eligible rows
+QUIZ_SAMPLE_MIN_QUESTIONS = 10000
+
+# The question count only decides whether quizzes sample pages, so it can be a
+# few minutes stale instead of costing a query on every quiz request
+_question_count_cache = TTLCache(maxsize=1, ttl=300)
+_question_count_lock = threading.Lock()
+
+
+def count_questions():
+    # The counters table is kept up to date by triggers, so this is a single row lookup
+    return db.session.query(Counter.n).filter(
+        Counter.name == "questions").scalar()
+
+
+def cached_question_count():
+    # Return the question count, reading the counters table when it has expired
+    with _question_count_lock:
+        count = _question_count_cache.get("questions")
+        if count is None:
+            count = count_questions()
+            _question_count_cache["questions"] = count
+
+    return count
+
+
+def format_questions(rows):
+    # Build the question dicts straight from the selected rows
+    return [
+        {
+            "id": row.id,
+            "question": row.question,
+            "answer": row.answer,
+            "category": row.category,
+            "difficulty": row.difficulty,
+        }
+        for row in rows
+    ]
+
+
+def random_question(source, category_id, asked_questions):
+    # Pick one random question from source (the questions table or a sample of it)
+    # that is in the quiz category, if not all, and has not been asked already.
+    # The ids are bound as one expanding parameter so the SQL stays the same
+    # whatever the list length
+    columns = [source.c[column.key] for column in QUESTION_COLUMNS]
+    query = db.session.query(*columns).filter(
+        source.c.id.notin_(bindparam("asked", expanding=True)))
+
+    if category_id != 0:
+        query = query.filter(source.c.category == category_id)
+
+    return query.order_by(func.random()).limit(1).params(
+        asked=asked_questions).first()
+
+
+def page_offset():
+    # Parse and validate the page parameter the first time a request needs it,
+    # then reuse the offset for the rest of the request
+    if "page_offset" not in g:
+        try:
+            page = int(request.args.get("page", 1))
+        except ValueError:
+            abort(400)
+
+        if page < 1 or (page - 1) * QUESTIONS_PER_PAGE > MAX_PAGE_OFFSET:
+            abort(400)
+
+        g.page_offset = (page - 1) * QUESTIONS_PER_PAGE
+
+    return g.page_offset
+
+
+def paginate_questions(query):
+    # Let the database do the slicing so only one page of rows is loaded
+    questions = query.limit(QUESTIONS_PER_PAGE).offset(page_offset()).all()
+
+    return format_questions(questions)
+
+
+def cached_categories():
+    # Return the cached categories dict and its ETag, querying the database when
+    # they have expired. A single get() avoids the entry expiring between a
+    # membership check and the lookup
+    with _categories_lock:
+        cached = _categories_cache.get("categories")
+        if cached is None:
+            categories = Category.query.order_by(Category.type).all()
+            data = {category.id: category.type for category in categories}
+            # The ETag only changes when the dict does, so hash it once per fill
+            etag = hashlib.md5(orjson.dumps(
+                data, option=orjson.OPT_NON_STR_KEYS)).hexdigest()
+            cached = (data, etag)
+            _categories_cache["categories"] = cached
+
+    return cached
 
-def paginate_questions(request, data):
-    # Get the page parameter from the request url
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
 
-    questions = [question.format() for question in data]
-    current_questions = questions[start:end]
+def categories_dict():
+    # Return just the cached {id: type} dict
+    return cached_categories()[0]
 
-    return current_questions
 
-def randomize(start, end):
-    return random.randrange(start, end)
+class ORJSONProvider(JSONProvider):
+    # Serialize responses with orjson instead of the stdlib json module
+    def dumps(self, obj, **kwargs):
+        # Category ids are used as dict keys, so allow non-string keys
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     setup_db(app)
 
-    CORS(app)
-
-    @app.after_request
-    def after_request(response):
-        response.headers.add(
-            "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
-        )
-        response.headers.add(
-            "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS"
-        )
-        return response
+    CORS(app, resources={
+        r"/*": {
+            "origins": "*",
+            "methods": ["GET", "PUT", "POST", "DELETE", "OPTIONS"],
+            "allow_headers": ["Content-Type", "Authorization", "true"],
+        }
+    })
 
     """
     Create an endpoint to handle GET requests for all available categories.
@@ -48,20 +185,26 @@ def create_app(test_config=None):
     @app.route("/categories")
     def retrieve_categories():
         # Get all the categories
-        categories = Category.query.order_by(Category.type).all()
+        categories, etag = cached_categories()
 
         if len(categories) == 0:
             abort(404)
 
-        return jsonify(
+        response = jsonify(
             {
                 "success": True,
-                "categories": {
-                    category.id: category.type for category in categories
-                },
-                "total_categories": len(Category.query.all())
+                "categories": categories,
+                "total_categories": len(categories)
             }
         )
+        # Let clients reuse their cached copy while the categories are unchanged
+        response.set_etag(etag, weak=True)
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+
+        # Turns the response into a 304 that keeps the ETag and Cache-Control
+        # headers when If-None-Match matches
+        return response.make_conditional(request)
 
     """
     Create an endpoint to handle GET requests for questions,
@@ -69,13 +212,12 @@ def create_app(test_config=None):
     """
     @app.route("/questions")
     def retrieve_questions():
-        # Get all the questions
-        data = Question.query.order_by(Question.id).all()
-
-        # Get 10 questions per page
-        current_questions = paginate_questions(request, data)
-
-        categories = Category.query.order_by(Category.type).all()
+        # Get 10 questions per page and the total number of questions at once
+        result = db.session.execute(QUESTIONS_PAGE_SQL, {
+            "limit": QUESTIONS_PER_PAGE,
+            "offset": page_offset(),
+        }).first()
+        current_questions = result.questions or []
 
         if len(current_questions) == 0:
             abort(400)
@@ -83,10 +225,8 @@ def create_app(test_config=None):
         return jsonify({
             "success": True,
             "questions": current_questions,
-            "total_questions": len(Question.query.all()),
-            "categories": {
-                category.id: category.type for category in categories
-            },
+            "total_questions": result.total_questions,
+            "categories": categories_dict(),
             "current_category": None,
         })
 
@@ -95,32 +235,38 @@ def create_app(test_config=None):
     """
     @app.route("/questions/<int:question_id>", methods=["DELETE"])
     def delete_question(question_id):
-        try:
-            # Get the question whose id matches that of the question to be deleted
-            question = Question.query.filter(
-                Question.id == question_id).one_or_none()
+        # Reject a bad page parameter before anything is deleted
+        page_offset()
 
-            # If the question does not exist:
-            if question is None:
-                abort(404)
+        # Get the question whose id matches that of the question to be deleted
+        question = Question.query.filter(
+            Question.id == question_id).one_or_none()
+
+        # If the question does not exist:
+        if question is None:
+            abort(404)
 
+        # Only the delete itself maps to 422; once it has committed, a failing
+        # read below must not tell the client that nothing happened
+        try:
             question.delete()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
 
-            # Get the remaining questions
-            data = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, data)
+        # Get the remaining questions
+        current_questions = paginate_questions(
+            db.session.query(*QUESTION_COLUMNS).order_by(Question.id))
 
-            return jsonify(
-                {
-                    "success": True,
-                    "deleted": question_id,
-                    "questions": current_questions,
-                    "total_questions": len(Question.query.all())
-                }
-            )
+        return jsonify(
+            {
+                "success": True,
+                "deleted": question_id,
+                "questions": current_questions,
+                "total_questions": count_questions()
+            }
+        )
 
-        except:
-            abort(422)
     """
     Create an endpoint to POST a new question,
     which will require the question and answer text,
@@ -129,31 +275,36 @@ def create_app(test_config=None):
     @app.route("/questions", methods=["POST"])
     def create_question():
         # Get the json request data
-        body = request.get_json()
+        body = request.get_json() or {}
 
         new_question = body.get("question", None)
         new_answer = body.get("answer", None)
         new_difficulty = body.get("difficulty", None)
         new_category = body.get("category", None)
 
+        # Reject a bad page parameter before anything is inserted
+        page_offset()
+
+        # Only the insert itself maps to 422; once it has committed, a failing
+        # read below must not tell the client that nothing was created
         try:
             # Create a new question from the data gotten from the request
             question = Question(question=new_question, answer=new_answer,
                                 category=new_category, difficulty=new_difficulty)
             question.insert()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
 
-            data = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, data)
+        current_questions = paginate_questions(
+            db.session.query(*QUESTION_COLUMNS).order_by(Question.id))
 
-            return jsonify({
-                "success": True,
-                "created": question.id,
-                "questions": current_questions,
-                "total_questions": len(Question.query.all())
-            })
-
-        except:
-            abort(422)
+        return jsonify({
+            "success": True,
+            "created": question.id,
+            "questions": current_questions,
+            "total_questions": count_questions()
+        })
 
     """
     Create a POST endpoint to get questions based on a search term.
@@ -161,16 +312,17 @@ def create_app(test_config=None):
     @app.route("/questions/search", methods=["POST"])
     def search_questions():
         # Get the search term from the json request data
-        search_term = request.get_json().get('searchTerm')
+        body = request.get_json() or {}
+        search_term = body.get('searchTerm')
 
         if search_term:
             # Get all the questions that match the search term (case-insensitive)
-            results = Question.query.filter(
+            results = db.session.query(*QUESTION_COLUMNS).filter(
                 Question.question.ilike(f'%{search_term}%')).all()
 
             return jsonify({
                 "success": True,
-                "questions": [result.format() for result in results],
+                "questions": format_questions(results),
                 "total_questions": len(results),
                 "current_category": None
             })
@@ -183,15 +335,15 @@ def create_app(test_config=None):
     @app.route("/categories/<int:category_id>/questions")
     def retrieve_questions_by_category(category_id):
         # Get the questions whose categories are equal to the specified category
-        questions = Question.query.filter(
-            Question.category == category_id).all()
+        questions = db.session.query(*QUESTION_COLUMNS).filter(
+            Question.category == category_id).order_by(Question.id).all()
 
         if len(questions) == 0:
             abort(404)
 
         return jsonify({
             "success": True,
-            "questions": [question.format() for question in questions],
+            "questions": format_questions(questions),
             "total_questions": len(questions),
             "current_category": category_id
         })
@@ -205,36 +357,38 @@ def create_app(test_config=None):
     @app.route("/quizzes", methods=["POST"])
     def start_quiz():
         try:
-            if not 'quiz_category' in request.get_json() and not 'previous_questions' in request.get_json():
+            # Get the json request data
+            body = request.get_json() or {}
+
+            if 'quiz_category' not in body or 'previous_questions' not in body:
                 abort(422)
 
-            category = request.get_json().get('quiz_category')
+            category = body.get('quiz_category')
             quiz_category_id = category['id']
-            asked_questions = request.get_json().get('previous_questions')
-
-            # If the category is all:
-            if quiz_category_id == 0:
-                free_questions = Question.query.filter(
-                    Question.id.notin_(asked_questions)).all()
-            else:
-            # Get the questions that are not in previous_questions i.e have not been asked already and whose category match the category from the request
-                free_questions = Question.query.filter_by(category=quiz_category_id).filter(
-                    Question.id.notin_(asked_questions)
-                ).all()
-
-            num_questions = len(free_questions)
-            if num_questions < 0:
-                current_question = None
-            else:
-                current_question = free_questions[randomize(
-                    0, num_questions)].format()
+            asked_questions = body.get('previous_questions')
+
+            # On large tables, first look in a random 1% of the pages instead of
+            # sorting every eligible row, falling back to the whole table if the
+            # sample has no free question
+            question = None
+            if cached_question_count() >= QUIZ_SAMPLE_MIN_QUESTIONS:
+                question = random_question(
+                    tablesample(Question.__table__, func.system(1)),
+                    quiz_category_id, asked_questions)
+            if question is None:
+                question = random_question(
+                    Question.__table__, quiz_category_id, asked_questions)
+            current_question = format_questions([question])[0] if question else None
 
             return jsonify({
                 "success": True,
                 "question": current_question
             })
 
-        except BaseException:
+        except HTTPException:
+            raise
+        except (KeyError, TypeError, SQLAlchemyError):
+            db.session.rollback()
             abort(422)
 
     """
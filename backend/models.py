@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, BigInteger, Index, DDL, event, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 from dotenv import load_dotenv
@@ -19,6 +19,14 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        # Room for every compiled statement the endpoints issue
+        "query_cache_size": 1200,
+    }
     db.app = app
     db.init_app(app)
     db.create_all()
@@ -36,9 +44,16 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer)
     difficulty = Column(Integer)
 
+    # The pg_trgm index used by search lives in trivia.psql only, so that
+    # create_all doesn't need the extension to be available
+    __table_args__ = (
+        # Serves the category filter and its ORDER BY id
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
@@ -86,3 +101,68 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+"""
+Counter
+    row count of questions, kept up to date by triggers on INSERT, DELETE and TRUNCATE
+
+"""
+
+
+class Counter(db.Model):
+    __tablename__ = 'counters'
+
+    name = Column(String, primary_key=True)
+    n = Column(BigInteger, nullable=False)
+
+
+# Runs after every create_all, once every table exists. Seeds the counter and
+# installs the function and triggers only when they are missing, so app start-up
+# doesn't take locks on questions or replace anything while traffic is live
+event.listen(
+    db.metadata,
+    'after_create',
+    DDL("""
+        INSERT INTO counters (name, n) VALUES
+            ('questions', (SELECT count(*) FROM questions))
+        ON CONFLICT (name) DO NOTHING;
+
+        DO $do$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'bump_counter') THEN
+                CREATE FUNCTION bump_counter() RETURNS trigger
+                    LANGUAGE plpgsql
+                    AS $$
+                BEGIN
+                    IF TG_OP = 'TRUNCATE' THEN
+                        UPDATE counters SET n = 0 WHERE name = TG_ARGV[0];
+                    ELSE
+                        UPDATE counters SET n = n + TG_ARGV[1]::integer WHERE name = TG_ARGV[0];
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$;
+            END IF;
+
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'questions_count_insert') THEN
+                CREATE TRIGGER questions_count_insert AFTER INSERT ON questions
+                    FOR EACH ROW EXECUTE PROCEDURE bump_counter('questions', '1');
+            END IF;
+
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'questions_count_delete') THEN
+                CREATE TRIGGER questions_count_delete AFTER DELETE ON questions
+                    FOR EACH ROW EXECUTE PROCEDURE bump_counter('questions', '-1');
+            END IF;
+
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'questions_count_truncate') THEN
+                CREATE TRIGGER questions_count_truncate AFTER TRUNCATE ON questions
+                    FOR EACH STATEMENT EXECUTE PROCEDURE bump_counter('questions', '0');
+            END IF;
+        EXCEPTION
+            -- Another worker installed them at the same time
+            WHEN duplicate_function OR duplicate_object THEN NULL;
+        END
+        $do$;
+    """)
+)
@@ -1,25 +1,36 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
-    def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}:{}@{}/{}".format(
-            "postgres", "admin", "localhost:5432", self.database_name
+    @classmethod
+    def setUpClass(cls):
+        """Initialize the app and create all tables once for the whole suite."""
+        cls.app = create_app()
+        cls.client = cls.app.test_client
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgresql://{}:{}@{}/{}".format(
+            "postgres", "admin", "localhost:5432", cls.database_name
         )
-        setup_db(self.app, self.database_path)
+        setup_db(cls.app, cls.database_path)
+
+        # binds the app to the current context
+        cls.app_context = cls.app.app_context()
+        cls.app_context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app_context.pop()
 
+    def setUp(self):
+        """Define test variables and run each test inside a transaction."""
         # Create a test question
         self.new_question = {
             "question": "What is a baby rabbit called?",
@@ -28,16 +39,29 @@ class TriviaTestCase(unittest.TestCase):
             "category": 1
         }
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        # Bind the session to a connection whose outer transaction is never
+        # committed, so the commits made by the endpoints are undone in tearDown.
+        # The endpoints commit and roll back a SAVEPOINT inside it instead.
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.original_session = db.session
+        db.session = db.create_scoped_session(
+            options={"bind": self.connection, "binds": {}})
+        self.nested = self.connection.begin_nested()
+        event.listen(db.session, "after_transaction_end", self.restart_savepoint)
+
+    def restart_savepoint(self, session, transaction):
+        """Start a new SAVEPOINT whenever an endpoint commits or rolls back."""
+        if not self.nested.is_active:
+            self.nested = self.connection.begin_nested()
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        event.remove(db.session, "after_transaction_end", self.restart_savepoint)
+        db.session.remove()
+        self.transaction.rollback()
+        self.connection.close()
+        db.session = self.original_session
 
     def test_get_categories(self):
         res = self.client().get('/categories')
@@ -48,6 +72,18 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total_categories"])
         self.assertTrue(len(data["categories"]))
 
+    def test_304_get_categories(self):
+        res = self.client().get('/categories')
+        etag = res.headers["ETag"]
+
+        res = self.client().get(
+            '/categories', headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b"")
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertIn("max-age=300", res.headers["Cache-Control"])
+
     def test_404_get_categories(self):
         res = self.client().get('/categories/1000')
         data = json.loads(res.data)
@@ -73,6 +109,36 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "Bad request. Please try again")
 
+    def test_400_invalid_page(self):
+        res = self.client().get('/questions?page=abc')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "Bad request. Please try again")
+
+    def test_400_page_too_large(self):
+        res = self.client().get('/questions?page=1000000000000000000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "Bad request. Please try again")
+
+    def test_400_page_too_large_does_not_create_question(self):
+        res = self.client().post(
+            '/questions?page={}'.format(10 ** 20), json=self.new_question)
+        question = Question.query.filter(
+            Question.question == self.new_question["question"]).one_or_none()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(question, None)
+
+    def test_invalid_page_ignored_on_categories(self):
+        res = self.client().get('/categories?page=abc')
+
+        self.assertEqual(res.status_code, 200)
+
     def test_get_questions_by_category(self):
         res = self.client().get('/categories/1/questions')
         data = json.loads(res.data)
@@ -96,6 +162,8 @@ class TriviaTestCase(unittest.TestCase):
             question='a question', answer='an answer', difficulty=1, category=4)
 
         test_question.insert()
+        total_questions = json.loads(
+            self.client().get('/questions').data)["total_questions"]
 
         res = self.client().delete('/questions/{}'.format(test_question.id))
         data = json.loads(res.data)
@@ -107,19 +175,27 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertEqual(data["deleted"], test_question.id)
         self.assertEqual(question, None)
+        self.assertEqual(data["total_questions"], total_questions - 1)
 
-    def test_422_question_does_not_exist(self):
+    def test_404_question_does_not_exist(self):
         res = self.client().delete('/questions/1000')
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "Request was unprocessable")
+        self.assertEqual(data["message"], "Resource not found")
 
     def test_create_new_question(self):
+        total_questions = json.loads(
+            self.client().get('/questions').data)["total_questions"]
+
         res = self.client().post('/questions', json=self.new_question)
         data = json.loads(res.data)
-        pass
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["created"])
+        self.assertEqual(data["total_questions"], total_questions + 1)
 
     def test_422_create_new_question(self):
         res = self.client().post('/questions', json=self.new_question)
@@ -160,6 +236,26 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_play_quiz_no_questions_left(self):
+        asked_questions = [
+            question.id for question in
+            Question.query.filter(Question.category == 4).all()
+        ]
+        quiz_data = {
+            'previous_questions': asked_questions,
+            'quiz_category': {
+                'type': 'History',
+                'id': 4
+            }
+        }
+
+        res = self.client().post('/quizzes', json=quiz_data)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["question"], None)
+
     def test_422_play_quiz(self):
         quiz_data = {
             'quiz_category': {